@@ -1,8 +1,14 @@
 import os
+import asyncio
 import logging
 import sqlite3
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache, wraps
 from typing import Dict, Tuple, List, Optional
+import aiosqlite
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 from cachetools import TTLCache
 
@@ -30,7 +36,7 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode
 from geopy.geocoders import Nominatim
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from geopy.geocoders import GoogleV3
 
 logging.basicConfig(
@@ -40,11 +46,26 @@ logging.basicConfig(
 logging.getLogger("geopy").setLevel(logging.WARNING)
 logging.getLogger("apscheduler").setLevel(logging.WARNING)
 geocoder_cache = TTLCache(maxsize=2000, ttl=3600)  # Увеличен размер кэша
+# Город и баланс меняются редко, а читаются на каждый inline-запрос
+user_cache = TTLCache(maxsize=10000, ttl=60)
+# Страницы каталога: одни и те же (город, позиция) запрашивают все
+# пользователи города, листающие поиск
+models_cache = TTLCache(maxsize=1024, ttl=30)
+
+def invalidate_models_cache(city: str):
+    """Сбрасывает закэшированные страницы города после правки каталога"""
+    city = city.lower()
+    for key in list(models_cache):
+        if key[0] == city:
+            models_cache.pop(key, None)
 
 # Конфигурация
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 DB_NAME = "bot_catalog.db"
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
+# Публичный URL для вебхука; без него бот работает через polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
 
 # Состояния
 (
@@ -68,63 +89,231 @@ google_geocoder = GoogleV3(
     timeout=15
 )
 
+class ConnectionPool:
+    """Одно соединение на запись + пул read-only соединений.
+
+    WAL позволяет читателям работать параллельно с писателем, поэтому
+    чтения (inline-поиск) не ждут записей (пополнение баланса).
+    """
+
+    def __init__(self, db_name: str, min_size: int = 2, max_size: int = 8):
+        self.db_name = db_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._reader_count = 0
+        # Метрики для /admin_pool_stats
+        self.active = 0
+        self.total_acquisitions = 0
+
+    async def open(self):
+        """Открывает пишущее соединение с нужными PRAGMA"""
+        self._writer = await aiosqlite.connect(
+            self.db_name, isolation_level=None, cached_statements=128
+        )
+        # Row собирает dict-подобные строки на стороне C — без
+        # cursor.description и dict(zip(...)) на каждую строку
+        self._writer.row_factory = aiosqlite.Row
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        await self._writer.execute("PRAGMA synchronous=NORMAL")
+        await self._writer.execute("PRAGMA temp_store=memory")
+        await self._writer.execute("PRAGMA cache_size=-64000")
+
+    async def warm(self):
+        """Заранее открывает min_size читателей (после создания схемы)"""
+        while self._reader_count < self.min_size:
+            await self._readers.put(await self._open_reader())
+            self._reader_count += 1
+
+    async def _open_reader(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            f"file:{self.db_name}?mode=ro", uri=True, cached_statements=128
+        )
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA cache_size=-64000")
+        return conn
+
+    @asynccontextmanager
+    async def acquire_read(self):
+        self.total_acquisitions += 1
+        try:
+            conn = self._readers.get_nowait()
+        except asyncio.QueueEmpty:
+            if self._reader_count < self.max_size:
+                # Слот резервируем до await: иначе всплеск конкурентных
+                # чтений проходит проверку одновременно и открывает
+                # соединения сверх max_size
+                self._reader_count += 1
+                try:
+                    conn = await self._open_reader()
+                except BaseException:
+                    self._reader_count -= 1
+                    raise
+            else:
+                conn = await self._readers.get()
+        self.active += 1
+        try:
+            yield conn
+        finally:
+            self.active -= 1
+            await self._readers.put(conn)
+
+    @asynccontextmanager
+    async def acquire_write(self):
+        self.total_acquisitions += 1
+        async with self._write_lock:
+            self.active += 1
+            try:
+                yield self._writer
+            finally:
+                self.active -= 1
+
+    @property
+    def idle(self) -> int:
+        return self._readers.qsize()
+
+    async def close(self):
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        if self._writer is not None:
+            await self._writer.close()
+
 class Database:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        self._initialize_db()
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
 
-    def _initialize_db(self):
+    @classmethod
+    async def connect(cls, db_name: str) -> "Database":
+        """Открывает пул соединений и создаёт таблицы"""
+        pool = ConnectionPool(db_name)
+        await pool.open()
+        db = cls(pool)
+        await db._initialize_db()
+        await pool.warm()
+        return db
+
+    async def _initialize_db(self):
         """Инициализация таблиц в базе данных"""
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                            (user_id INTEGER PRIMARY KEY, 
-                             city TEXT, 
-                             balance INTEGER DEFAULT 0)''')
-
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS models
-                            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            name TEXT, 
-                            age INTEGER, 
-                            city TEXT,
-                            photos TEXT, 
-                            price INTEGER)''')
-
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS orders
-                            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER, 
-                            model_id INTEGER,
-                            hours INTEGER, 
-                            services TEXT,
-                            total INTEGER, 
-                            status TEXT)''')
-        
-        self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_models_city 
-                            ON models(city)''')
-        self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_orders_user 
-                            ON orders(user_id)''')
-        self.conn.commit()
+        async with self.pool.acquire_write() as conn:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS users
+                                (user_id INTEGER PRIMARY KEY,
+                                 city TEXT,
+                                 balance INTEGER DEFAULT 0)''')
 
-    def execute(self, query: str, params: tuple = ()) -> None:
-        try:
-            self.cursor.execute(query, params)
-            self.conn.commit()
-        except sqlite3.Error as e:
-            logging.error(f"Database error: {e}")
-            self.conn.rollback()
-        
-    def fetch_one(self, query: str, params: tuple = ()) -> Optional[Dict]:
-        self.cursor.execute(query, params)
-        columns = [col[0] for col in self.cursor.description]
-        row = self.cursor.fetchone()
-        return dict(zip(columns, row)) if row else None
-        
-    def fetch_all(self, query: str, params: tuple = ()) -> List[Dict]:
-        self.cursor.execute(query, params)
-        columns = [col[0] for col in self.cursor.description]
-        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+            await conn.execute('''CREATE TABLE IF NOT EXISTS models
+                                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                name TEXT,
+                                age INTEGER,
+                                city TEXT COLLATE NOCASE,
+                                photos TEXT,
+                                price INTEGER)''')
+
+            await conn.execute('''CREATE TABLE IF NOT EXISTS orders
+                                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id INTEGER,
+                                model_id INTEGER,
+                                hours INTEGER,
+                                services TEXT,
+                                total INTEGER,
+                                status TEXT)''')
+
+            await conn.execute('''CREATE TABLE IF NOT EXISTS geo_cache
+                                (lat REAL,
+                                lon REAL,
+                                city TEXT,
+                                ts INTEGER,
+                                PRIMARY KEY(lat, lon))''')
+
+            await conn.execute('''CREATE TABLE IF NOT EXISTS file_ids
+                                (key TEXT PRIMARY KEY,
+                                file_id TEXT)''')
+
+            await conn.execute('DROP INDEX IF EXISTS idx_models_city_lower')
+            await conn.execute('''CREATE INDEX IF NOT EXISTS idx_models_city
+                                ON models(city)''')
+            await conn.execute('''CREATE INDEX IF NOT EXISTS idx_orders_user
+                                ON orders(user_id)''')
+
+            # Миграция старых записей: раньше город хранился как ввёл
+            # админ. LOWER()/NOCASE в SQLite не трогают кириллицу,
+            # поэтому нормализуем на стороне Python
+            async with conn.execute(
+                "SELECT id, city FROM models WHERE city IS NOT NULL"
+            ) as cur:
+                rows = await cur.fetchall()
+            for row in rows:
+                lowered = row['city'].lower()
+                if lowered != row['city']:
+                    await conn.execute(
+                        "UPDATE models SET city = ? WHERE id = ?",
+                        (lowered, row['id'])
+                    )
+            await conn.commit()
+
+    async def execute(self, query: str, params: tuple = ()) -> None:
+        async with self.pool.acquire_write() as conn:
+            try:
+                await conn.execute(query, params)
+                await conn.commit()
+            except aiosqlite.Error as e:
+                logging.error(f"Database error: {e}")
+                await conn.rollback()
+
+    async def execute_returning(self, query: str,
+                                params: tuple = ()) -> Optional[aiosqlite.Row]:
+        """Пишущий запрос с RETURNING: одна поездка вместо UPDATE+SELECT"""
+        async with self.pool.acquire_write() as conn:
+            try:
+                async with conn.execute(query, params) as cur:
+                    row = await cur.fetchone()
+                await conn.commit()
+                return row
+            except aiosqlite.Error as e:
+                logging.error(f"Database error: {e}")
+                await conn.rollback()
+                return None
+
+    async def fetch_one(self, query: str,
+                        params: tuple = ()) -> Optional[aiosqlite.Row]:
+        async with self.pool.acquire_read() as conn:
+            async with conn.execute(query, params) as cur:
+                return await cur.fetchone()
 
-# Инициализация базы данных
-db = Database(DB_NAME)
+    async def fetch_all(self, query: str,
+                        params: tuple = ()) -> List[aiosqlite.Row]:
+        async with self.pool.acquire_read() as conn:
+            async with conn.execute(query, params) as cur:
+                return await cur.fetchall()
+
+    # Текст горячего запроса фиксирован, чтобы sqlite3 переиспользовал
+    # подготовленный стейтмент из кэша соединения (cached_statements).
+    # Keyset-пагинация по id: OFFSET N заставляет SQLite пропустить N
+    # строк, WHERE id > ? сразу встаёт на нужное место индекса.
+    # Город нормализуется при записи, поэтому сравнение прямое
+    _MODELS_BY_CITY = (
+        "SELECT id, name, age, city, photos, price FROM models "
+        "WHERE city = ? AND id > ? ORDER BY id LIMIT ?"
+    )
+
+    async def list_models_by_city(self, city: str, after_id: int,
+                                  limit: int) -> List[Tuple]:
+        """Горячий путь inline-поиска: строки-кортежи без dict-обёртки.
+
+        Запрашивает limit+1 строк — лишняя строка показывает, что есть
+        следующая страница, без отдельного запроса COUNT.
+        """
+        async with self.pool.acquire_read() as conn:
+            async with conn.execute(self._MODELS_BY_CITY,
+                                    (city, after_id, limit + 1)) as cur:
+                # Кортежи, не Row: хешируются для lru_cache карточек.
+                # map вместо list comprehension — без байткода цикла
+                # на каждую строку
+                return list(map(tuple, await cur.fetchall()))
+
+# Инициализируется в post_init, когда появляется event loop
+db: Optional[Database] = None
 
 def check_geocoder():
     try:
@@ -133,59 +322,109 @@ def check_geocoder():
     except Exception as e:
         logging.critical(f"Geocoder connection failed: {e}")
 
+def _city_from_nominatim(lat: float, lon: float) -> str:
+    """Блокирующий запрос к Nominatim; вызывать через asyncio.to_thread"""
+    geo_location = geolocator.reverse(
+        (lat, lon),
+        exactly_one=True,
+        language="ru",
+        addressdetails=True
+    )
+    if not geo_location:
+        return 'Unknown'
+    address = geo_location.raw.get('address', {})
+    return (
+        address.get('city')
+        or address.get('town')
+        or address.get('village')
+        or address.get('county')
+        or address.get('state')
+        or 'Unknown'
+    )
+
+def _city_from_google(lat: float, lon: float) -> str:
+    """Блокирующий запрос к Google; вызывать через asyncio.to_thread"""
+    google_location = google_geocoder.reverse(
+        (lat, lon),
+        exactly_one=True,
+        language="ru"
+    )
+    if not google_location:
+        return 'Unknown'
+    address = google_location.raw.get('address_components', [])
+    return next(
+        (comp['long_name'] for comp in address
+         if 'locality' in comp['types'] or
+            'administrative_area_level_2' in comp['types']),
+        'Unknown'
+    )
+
+async def _remember_city(lat: float, lon: float, city: str):
+    """Кладёт город в оба кэша: TTLCache и таблицу geo_cache"""
+    geocoder_cache[f"{lat}_{lon}"] = city
+    await db.execute(
+        "INSERT OR REPLACE INTO geo_cache (lat, lon, city, ts) VALUES (?, ?, ?, ?)",
+        (lat, lon, city, int(datetime.now().timestamp()))
+    )
+
 async def get_city_from_location(location: Location) -> str:
-    cache_key = f"{location.latitude}_{location.longitude}"
-    
+    # Огрубляем координаты до ~10 м: для определения города этого
+    # достаточно, а доля попаданий в кэш резко растёт
+    lat = round(location.latitude, 4)
+    lon = round(location.longitude, 4)
+    cache_key = f"{lat}_{lon}"
+
     if cache_key in geocoder_cache:
         logging.info(f"Using cached city for {cache_key}")
         return geocoder_cache[cache_key]
-    
+
+    # L2: таблица geo_cache переживает рестарты бота
+    cached = await db.fetch_one(
+        "SELECT city FROM geo_cache WHERE lat = ? AND lon = ?", (lat, lon)
+    )
+    if cached:
+        geocoder_cache[cache_key] = cached['city']
+        logging.info(f"Using persisted city for {cache_key}")
+        return cached['city']
+
     try:
-        # Попытка через Nominatim
-        geo_location = geolocator.reverse(
-            (location.latitude, location.longitude),
-            exactly_one=True,
-            language="ru",
-            addressdetails=True
-        )
-        
-        if geo_location:
-            address = geo_location.raw.get('address', {})
-            city = (
-                address.get('city') 
-                or address.get('town') 
-                or address.get('village')
-                or address.get('county')
-                or address.get('state')
-                or 'Unknown'
-            )
-            
-            if city != 'Unknown':
-                geocoder_cache[cache_key] = city
-                logging.info(f"Nominatim success: {city}")
-                return city
-
-        # Если Nominatim не справился, пробуем Google
-        logging.warning("Falling back to Google Geocoder")
-        google_location = google_geocoder.reverse(
-            (location.latitude, location.longitude),
-            exactly_one=True,
-            language="ru"
-        )
-        
-        if google_location:
-            address = google_location.raw.get('address_components', [])
-            city = next(
-                (comp['long_name'] for comp in address 
-                 if 'locality' in comp['types'] or 
-                    'administrative_area_level_2' in comp['types']),
-                'Unknown'
+        # Оба геокодера стартуют одновременно; берём первый пригодный
+        # ответ и отменяем второй — латентность ~ min, а не сумма
+        tasks = {
+            asyncio.create_task(
+                asyncio.to_thread(_city_from_nominatim, lat, lon),
+                name="Nominatim"
+            ),
+            asyncio.create_task(
+                asyncio.to_thread(_city_from_google, lat, lon),
+                name="Google"
+            ),
+        }
+
+        city = 'Unknown'
+        winner = None
+        while tasks and city == 'Unknown':
+            done, tasks = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
             )
-            
-            if city != 'Unknown':
-                geocoder_cache[cache_key] = city
-                logging.info(f"Google Geocoder success: {city}")
-                return city
+            for task in done:
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logging.error(f"{task.get_name()} failed: {e}")
+                    continue
+                if result != 'Unknown':
+                    city = result
+                    winner = task.get_name()
+                    break
+
+        for task in tasks:
+            task.cancel()
+
+        if city != 'Unknown':
+            await _remember_city(lat, lon, city)
+            logging.info(f"{winner} success: {city}")
+            return city
 
         logging.error("All geocoders failed")
         return 'Unknown'
@@ -211,10 +450,67 @@ def check_geocoders():
     except Exception as e:
         logging.critical(f"Geocoder test failed: {e}")
 
-async def send_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, 
+# Картинки меню: заливаются в Telegram один раз, дальше шлём file_id
+# вместо повторной загрузки файла с диска на каждый /start
+MENU_IMAGES = {
+    'welcome': 'welcome.jpg',
+    'main_menu': 'main_menu.jpg',
+}
+FILE_IDS: Dict[str, str] = {}
+
+async def load_file_ids(bot):
+    """Подхватывает file_id картинок из БД, при первом запуске заливает
+    файлы админу и запоминает выданные Telegram file_id"""
+    for key, path in MENU_IMAGES.items():
+        row = await db.fetch_one(
+            "SELECT file_id FROM file_ids WHERE key = ?", (key,)
+        )
+        if row:
+            FILE_IDS[key] = row['file_id']
+            continue
+        try:
+            with open(path, 'rb') as f:
+                msg = await bot.send_photo(ADMIN_ID, f)
+            file_id = msg.photo[-1].file_id
+            await db.execute(
+                "INSERT OR REPLACE INTO file_ids (key, file_id) VALUES (?, ?)",
+                (key, file_id)
+            )
+            FILE_IDS[key] = file_id
+            logging.info(f"Uploaded {path}, file_id cached")
+        except Exception as e:
+            logging.error(f"Failed to upload {path}: {e}")
+
+# Telegram пропускает ~30 сообщений/сек на бота; 28 — с запасом,
+# чтобы при всплеске нажатий не ловить 429 и не копить очередь в PTB
+send_bucket = AsyncLimiter(28, 1)
+
+async def safe_send(fn, *args, **kwargs):
+    """Пропускает исходящий вызов API через общий token bucket"""
+    async with send_bucket:
+        return await fn(*args, **kwargs)
+
+# Последняя удачная правка по сообщению: повтор с теми же текстом и
+# клавиатурой схлопываем — Telegram ответил бы 400 message is not modified
+_last_edits = TTLCache(maxsize=2048, ttl=5)
+
+async def safe_edit_text(message, text: str, **kwargs):
+    """edit_text через лимитер со схлопыванием одинаковых правок"""
+    key = (message.chat_id, message.message_id)
+    entry = (text, kwargs.get('reply_markup'))
+    if _last_edits.get(key) == entry:
+        return
+    result = await safe_send(message.edit_text, text, **kwargs)
+    # Запоминаем только после успешной отправки: упавшая правка не
+    # должна глушить повторную попытку с тем же текстом
+    _last_edits[key] = entry
+    return result
+
+async def send_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
                    file_id: str, caption: str, reply_markup=None):
     try:
-        await context.bot.send_photo(
+        await safe_send(
+            context.bot.send_photo,
             chat_id=chat_id,
             photo=file_id,
             caption=caption,
@@ -224,10 +520,29 @@ async def send_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
     except Exception as e:
         logging.error(f"Error sending photo: {e}")
 
+chat_locks = defaultdict(asyncio.Lock)
+
+def per_chat_lock(handler):
+    """Сериализует обработку апдейтов внутри одного чата.
+
+    С concurrent_updates апдейты обрабатываются параллельно; без
+    блокировки два сообщения одного пользователя могут обогнать друг
+    друга и сломать состояние диалога. Разные чаты идут параллельно.
+    """
+    @wraps(handler)
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context)
+        async with chat_locks[chat.id]:
+            return await handler(update, context)
+    return wrapped
+
 # Обработчики команд
+@per_chat_lock
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.execute(
+    await db.execute(
         "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
         (user_id,)
     )
@@ -237,23 +552,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_photo(
         context,
         update.effective_chat.id,
-        "welcome.jpg",
+        FILE_IDS.get('welcome', 'welcome.jpg'),
         "Добро пожаловать!\n\nПользуясь нашим бот-каталогом...",
         InlineKeyboardMarkup(keyboard)
     )
 
+@per_chat_lock
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"Получена геопозиция: {update.message.location}")
     try:
         city = await get_city_from_location(update.message.location)
         logging.info(f"Определен город: {city}")  # Добавлено
         if city == 'Unknown':
-            await update.message.reply_text("❌ Не удалось определить город. Попробуйте ввести вручную.")
+            await safe_send(update.message.reply_text, "❌ Не удалось определить город. Попробуйте ввести вручную.")
             return MANUAL_CITY_INPUT
         return await validate_and_confirm_city(update, context, city)
     except Exception as e:
         logging.error(f"Ошибка обработки геопозиции: {e}")
-        await update.message.reply_text("❌ Ошибка определения города. Попробуйте ещё раз или введите вручную.")
+        await safe_send(update.message.reply_text, "❌ Ошибка определения города. Попробуйте ещё раз или введите вручную.")
         return MANUAL_CITY_INPUT
 
 async def ask_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -262,15 +578,16 @@ async def ask_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [KeyboardButton("🏙 Ввести город вручную")]
     ]
     
-    await update.callback_query.message.reply_text(
+    await safe_send(update.callback_query.message.reply_text, 
         "Разрешите доступ к геопозиции или введите город:",
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     )
     return SELECT_CITY
 
+@per_chat_lock
 async def handle_manual_city_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "🏙 Ввести город вручную":
-        await update.message.reply_text("Введите город:")
+        await safe_send(update.message.reply_text, "Введите город:")
         return MANUAL_CITY_INPUT
     # Добавьте обработку текста города
     city = update.message.text
@@ -278,9 +595,12 @@ async def handle_manual_city_input(update: Update, context: ContextTypes.DEFAULT
 
 async def validate_city(city: str) -> bool:
     try:
-        location = geolocator.geocode(
-            city, 
-            exactly_one=True, 
+        # geocode блокирующий — в отдельный поток, чтобы не стопорить
+        # event loop на время HTTP-запроса
+        location = await asyncio.to_thread(
+            geolocator.geocode,
+            city,
+            exactly_one=True,
             language="ru",
             timeout=15
         )
@@ -296,13 +616,14 @@ async def validate_city(city: str) -> bool:
 async def validate_and_confirm_city(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
     # Сохраняем город в базу данных
     user_id = update.effective_user.id
-    db.execute(
+    await db.execute(
         "UPDATE users SET city = ? WHERE user_id = ?",
         (city.lower(), user_id)
     )
+    user_cache.pop(user_id, None)
     
     if not await validate_city(city):
-        await update.message.reply_text("Не удалось найти такой город. Попробуйте ещё раз:")
+        await safe_send(update.message.reply_text, "Не удалось найти такой город. Попробуйте ещё раз:")
         return MANUAL_CITY_INPUT
 
     context.user_data['city'] = city.lower()
@@ -311,7 +632,8 @@ async def validate_and_confirm_city(update: Update, context: ContextTypes.DEFAUL
         [InlineKeyboardButton("🔄 Изменить город", callback_data='change_city')]
     ]
 
-    await context.bot.send_message(
+    await safe_send(
+        context.bot.send_message,
         chat_id=update.effective_chat.id,
         text=f"Подтвердите выбор города: {city.capitalize()}",
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -320,7 +642,8 @@ async def validate_and_confirm_city(update: Update, context: ContextTypes.DEFAUL
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if 'wait_message_id' in context.user_data:
-        await context.bot.delete_message(
+        await safe_send(
+            context.bot.delete_message,
             chat_id=update.effective_chat.id,
             message_id=context.user_data['wait_message_id']
         )
@@ -333,56 +656,69 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_photo(
         context,
         update.effective_chat.id,
-        "main_menu.jpg",
+        FILE_IDS.get('main_menu', 'main_menu.jpg'),
         "Главное меню",
         InlineKeyboardMarkup(keyboard)
     )
     return MAIN_MENU
 
+@lru_cache(maxsize=256)
+def _next_page_markup(next_offset: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Следующая страница",
+            switch_inline_query_current_chat=f"page_{next_offset}")]
+    ])
+
+@lru_cache(maxsize=1024)
+def _article_for(row: Tuple, next_offset: Optional[int]) -> InlineQueryResultArticle:
+    """Готовая карточка модели; кэшируется, пока каталог не меняется"""
+    model_id, name, age, city, photos, price = row
+    return InlineQueryResultArticle(
+        id=str(model_id),
+        title=name,
+        input_message_content=InputTextMessageContent(
+            f"{name} · {age} · {city}"
+        ),
+        description=f"Стоимость: {price}₽",
+        thumb_url=photos,
+        reply_markup=_next_page_markup(next_offset)
+            if next_offset is not None else None
+    )
+
 async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.inline_query.from_user.id
-        user_data = db.fetch_one("SELECT city FROM users WHERE user_id = ?", (user_id,))
+        user_data = await get_user(user_id)
         
-        if not user_data or not user_data.get('city'):
+        if not user_data or not user_data['city']:
             await update.inline_query.answer([])
             return
 
-        city = user_data['city'].lower()
+        # users.city и models.city уже нормализованы при записи
+        city = user_data['city']
         query = update.inline_query.query
-        offset = int(update.inline_query.offset or 0)
+        # В offset передаём id последней показанной модели, не номер
+        # страницы — так SQLite не пропускает строки впустую
+        after_id = int(update.inline_query.offset or 0)
         page_size = 5
 
-        models = db.fetch_all(
-            """SELECT * FROM models 
-            WHERE LOWER(city) = ? 
-            LIMIT ? OFFSET ?""",
-            (city, page_size, offset)
-        )
-        
-        results = []
-        next_offset = offset + page_size
-        
-        for model in models:
-            results.append(
-                InlineQueryResultArticle(
-                    id=str(model['id']),
-                    title=model['name'],
-                    input_message_content=InputTextMessageContent(
-                        f"{model['name']} · {model['age']} · {model['city']}"
-                    ),
-                    description=f"Стоимость: {model['price']}₽",
-                    thumb_url=model['photos'],
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("Следующая страница", 
-                            switch_inline_query_current_chat=f"page_{next_offset}")]
-                    ]) if len(models) == page_size else None
-                )
-            )
+        cache_key = (city, after_id)
+        rows = models_cache.get(cache_key)
+        if rows is None:
+            rows = await db.list_models_by_city(city, after_id, page_size)
+            models_cache[cache_key] = rows
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        next_offset = rows[-1][0] if rows else 0
+        results = [
+            _article_for(tuple(row), next_offset if has_more else None)
+            for row in rows
+        ]
 
         await update.inline_query.answer(
-            results, 
-            next_offset=str(next_offset) if results else None
+            results,
+            next_offset=str(next_offset) if has_more else None
         )
     except Exception as e:
         logging.error(f"Inline query error: {e}")
@@ -401,13 +737,15 @@ async def handle_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("Вернуться в мой аккаунт", callback_data='back')]
     ]
     
-    await context.bot.send_message(
+    await safe_send(
+        context.bot.send_message,
         chat_id=update.effective_chat.id,
         text="Выберите способ пополнения:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     return DEPOSIT_AMOUNT
 
+@per_chat_lock
 async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         amount = float(update.message.text.replace(',', '.'))
@@ -417,32 +755,44 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
         amount_kopecks = int(amount * 100)
         user_id = update.effective_user.id
         
-        db.execute(
-            '''UPDATE users SET balance = balance + ? 
-            WHERE user_id = ?''',
+        row = await db.execute_returning(
+            '''UPDATE users SET balance = balance + ?
+            WHERE user_id = ? RETURNING balance''',
             (amount_kopecks, user_id)
         )
+        user_cache.pop(user_id, None)
 
-        await update.message.reply_text(
+        new_balance = row['balance'] / 100 if row else 0.0
+        await safe_send(update.message.reply_text, 
             f"✅ Баланс успешно пополнен на {amount:.2f}₽\n"
-            f"Новый баланс: {await get_user_balance(user_id):.2f}₽"
+            f"Новый баланс: {new_balance:.2f}₽"
         )
 
     except ValueError:
-        await update.message.reply_text("❌ Некорректная сумма. Введите число от 100 до 100 000:")
+        await safe_send(update.message.reply_text, "❌ Некорректная сумма. Введите число от 100 до 100 000:")
         return DEPOSIT_AMOUNT
 
+async def get_user(user_id: int) -> Optional[aiosqlite.Row]:
+    """Запись пользователя с минутным кэшем; инвалидируется при смене
+    города или баланса"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.fetch_one(
+            "SELECT user_id, city, balance FROM users WHERE user_id = ?",
+            (user_id,)
+        )
+        if user is not None:
+            user_cache[user_id] = user
+    return user
+
 async def get_user_balance(user_id: int) -> float:
-    user = db.fetch_one(
-        "SELECT balance FROM users WHERE user_id = ?", 
-        (user_id,)
-    )
-    return user['balance'] / 100 if user and user.get('balance') else 0.0
+    user = await get_user(user_id)
+    return user['balance'] / 100 if user and user['balance'] else 0.0
 
 # Админ-панель
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("🚫 Доступ запрещён!")
+        await safe_send(update.message.reply_text, "🚫 Доступ запрещён!")
         return ConversationHandler.END
 
     keyboard = [
@@ -452,19 +802,34 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
          InlineKeyboardButton("📦 Резервная копия", callback_data='backup')]
     ]
 
-    await update.message.reply_text(
+    await safe_send(update.message.reply_text, 
         "🛠 Админ-панель:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+async def admin_pool_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await safe_send(update.message.reply_text, "🚫 Доступ запрещён!")
+        return
+
+    pool = db.pool
+    await safe_send(update.message.reply_text, 
+        f"📊 Пул соединений:\n"
+        f"Активных: {pool.active}\n"
+        f"Свободных читателей: {pool.idle}\n"
+        f"Открыто читателей: {pool._reader_count} (макс. {pool.max_size})\n"
+        f"Всего захватов: {pool.total_acquisitions}"
+    )
+
 async def add_model_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.message.reply_text(
+    await safe_send(update.callback_query.message.reply_text, 
         "Введите данные модели в формате:\n"
         "Имя | Возраст | Город | Цена\n"
         "Пример: Анна | 25 | Москва | 5000"
     )
     return GET_MODEL_DATA
 
+@per_chat_lock
 async def save_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         parts = list(map(str.strip, update.message.text.split('|')))
@@ -481,40 +846,44 @@ async def save_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['new_model'] = {
             'name': name,
             'age': age,
-            'city': city,
+            # Город — в нижнем регистре, как и users.city
+            'city': city.lower(),
             'price': price
         }
         
-        await update.message.reply_text("Теперь отправьте фото модели")
+        await safe_send(update.message.reply_text, "Теперь отправьте фото модели")
         return GET_MODEL_PHOTO
         
     except Exception as e:
         logging.error(f"Model save error: {e}")
-        await update.message.reply_text("Ошибка формата! Попробуйте снова")
+        await safe_send(update.message.reply_text, "Ошибка формата! Попробуйте снова")
         return GET_MODEL_DATA
 
+@per_chat_lock
 async def save_model_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         photo = update.message.photo[-1]
         file_id = photo.file_id
         model = context.user_data['new_model']
         
-        db.execute('''INSERT INTO models 
+        await db.execute('''INSERT INTO models
                    (name, age, city, photos, price)
                    VALUES (?, ?, ?, ?, ?)''',
-                   (model['name'], model['age'], 
+                   (model['name'], model['age'],
                     model['city'], file_id, model['price']))
-        
-        await update.message.reply_text("Модель успешно добавлена!")
+        _article_for.cache_clear()
+        invalidate_models_cache(model['city'])
+
+        await safe_send(update.message.reply_text, "Модель успешно добавлена!")
     except Exception as e:
         logging.error(f"Photo save error: {e}")
-        await update.message.reply_text("Ошибка сохранения модели!")
+        await safe_send(update.message.reply_text, "Ошибка сохранения модели!")
     finally:
         context.user_data.pop('new_model', None)
         return ConversationHandler.END
 
 async def delete_model_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    models = db.fetch_all("SELECT id, name FROM models LIMIT 50")
+    models = await db.fetch_all("SELECT id, name FROM models LIMIT 50")
     
     keyboard = [
         [InlineKeyboardButton(f"{m['id']}: {m['name']}", callback_data=f"del_{m['id']}")]
@@ -522,23 +891,26 @@ async def delete_model_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='back_admin')])
 
-    await update.callback_query.message.edit_text(
+    await safe_edit_text(
+        update.callback_query.message,
         "Выберите модель для удаления:",
         reply_markup=InlineKeyboardMarkup(keyboard))
     return CONFIRM_DELETE_MODEL
 
 async def confirm_delete_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     model_id = int(update.callback_query.data.split('_')[1])
-    model = db.fetch_one("SELECT * FROM models WHERE id = ?", (model_id,))
+    model = await db.fetch_one("SELECT * FROM models WHERE id = ?", (model_id,))
     
     context.user_data['pending_delete'] = model_id
-    
+    context.user_data['pending_delete_city'] = model['city']
+
     keyboard = [
         [InlineKeyboardButton("✅ Подтвердить удаление", callback_data='confirm_del')],
         [InlineKeyboardButton("🔙 Отмена", callback_data='cancel_del')]
     ]
 
-    await update.callback_query.message.edit_text(
+    await safe_edit_text(
+        update.callback_query.message,
         f"Вы уверены, что хотите удалить модель?\n"
         f"ID: {model['id']}\nИмя: {model['name']}\nГород: {model['city']}",
         reply_markup=InlineKeyboardMarkup(keyboard))
@@ -549,71 +921,132 @@ def backup_db():
     try:
         backup_dir = os.path.abspath(os.getenv("BACKUP_DIR", "backups"))
         os.makedirs(backup_dir, exist_ok=True)
-        
+
         backup_name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M')}.db"
         backup_path = os.path.join(backup_dir, backup_name)
-        
-        with open(backup_path, 'wb') as f:
-            for line in db.conn.iterdump():
-                f.write(f'{line}\n'.encode('utf-8'))
-        
+
+        # Отдельное соединение: основное живёт в event loop, WAL
+        # позволяет читать параллельно с записью. Копируем страницами
+        # через C-шный backup API — писатели не блокируются надолго
+        src = sqlite3.connect(DB_NAME)
+        dest = sqlite3.connect(backup_path)
+        try:
+            with dest:
+                src.backup(dest, pages=100, sleep=0.001)
+        finally:
+            dest.close()
+            src.close()
+
         logging.info(f"Backup created: {backup_path}")
     except Exception as e:
         logging.error(f"Backup failed: {e}")
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(backup_db, 'interval', hours=24)
-scheduler.start()
+async def backup_db_async():
+    # Сам бэкап блокирующий (sqlite3.backup) — уводим в поток
+    await asyncio.to_thread(backup_db)
 
-async def handle_callback_queries(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        await query.answer()
-    except Exception as e:
-        logging.error(f"Callback error: {e}")
-        return
+# Стартует в post_init: AsyncIOScheduler нужен работающий event loop
+scheduler = AsyncIOScheduler()
 
-    data = query.data
-    user_data = context.user_data
-    
-    if data == 'continue':
-        return await ask_city(update, context)
-    
-    elif data == 'my_account':
-        return await show_account_menu(update, context)
-    
-    elif data == 'deposit_card':
-        await query.edit_message_text("Введите сумму для пополнения (от 100 до 100 000 ₽):")
-        return DEPOSIT_AMOUNT
-    
-    elif data == 'back':
-        return await show_main_menu(update, context)
-    
-    elif data == 'add_model':
-        return await add_model_flow(update, context)
-    
-    elif data.startswith('del_'):
-        return await confirm_delete_model(update, context)
-    
-    elif data == 'confirm_del':
-        model_id = user_data.get('pending_delete')
-        db.execute("DELETE FROM models WHERE id = ?", (model_id,))
-        await query.edit_message_text("Модель успешно удалена!")
-        return await admin_panel(update, context)
-    
-    elif data == 'cancel_del':
-        return await delete_model_flow(update, context)
-    
-    elif data == 'back_admin':
-        return await admin_panel(update, context)
-        
-    elif data == 'auto_city':
-        await query.message.reply_text("Отправьте ваше местоположение:")
-        return SELECT_CITY
-    
-    elif data == 'manual_city':
-        await query.message.reply_text("Введите город вручную:")
-        return MANUAL_CITY_INPUT
+def callback_action(handler):
+    """Общая обвязка кнопочных обработчиков: answer() и блокировка чата"""
+    @wraps(handler)
+    @per_chat_lock
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await update.callback_query.answer()
+        except Exception as e:
+            logging.error(f"Callback error: {e}")
+            return
+        return await handler(update, context)
+    return wrapped
+
+@callback_action
+async def on_continue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await ask_city(update, context)
+
+@callback_action
+async def on_my_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await show_account_menu(update, context)
+
+@callback_action
+async def on_deposit_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await safe_edit_text(
+        update.callback_query.message,
+        "Введите сумму для пополнения (от 100 до 100 000 ₽):"
+    )
+    return DEPOSIT_AMOUNT
+
+@callback_action
+async def on_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await show_main_menu(update, context)
+
+@callback_action
+async def on_add_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await add_model_flow(update, context)
+
+@callback_action
+async def on_confirm_del(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    model_id = context.user_data.get('pending_delete')
+    await db.execute("DELETE FROM models WHERE id = ?", (model_id,))
+    _article_for.cache_clear()
+    model_city = context.user_data.pop('pending_delete_city', None)
+    if model_city:
+        invalidate_models_cache(model_city)
+    await safe_edit_text(update.callback_query.message, "Модель успешно удалена!")
+    return await admin_panel(update, context)
+
+@callback_action
+async def on_cancel_del(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await delete_model_flow(update, context)
+
+@callback_action
+async def on_back_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await admin_panel(update, context)
+
+@callback_action
+async def on_auto_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await safe_send(update.callback_query.message.reply_text, "Отправьте ваше местоположение:")
+    return SELECT_CITY
+
+@callback_action
+async def on_manual_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await safe_send(update.callback_query.message.reply_text, "Введите город вручную:")
+    return MANUAL_CITY_INPUT
+
+@callback_action
+async def on_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Как и раньше: кнопки подтверждения города только гасят "часики"
+    return None
+
+@callback_action
+async def on_unhandled_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Кнопки без действия (stats, backup, orders_history и т.п.):
+    # answer() в callback_action гасит "часики", больше ничего не нужно
+    return None
+
+def build_callback_handlers() -> List[CallbackQueryHandler]:
+    """Отдельный обработчик на каждую кнопку: PTB матчит
+    прекомпилированные регэкспы вместо длинной elif-цепочки"""
+    return [
+        CallbackQueryHandler(on_continue, pattern=r'^continue$'),
+        CallbackQueryHandler(on_my_account, pattern=r'^my_account$'),
+        CallbackQueryHandler(on_deposit_card, pattern=r'^deposit_card$'),
+        CallbackQueryHandler(on_back, pattern=r'^back$'),
+        CallbackQueryHandler(on_add_model, pattern=r'^add_model$'),
+        CallbackQueryHandler(callback_action(confirm_delete_model),
+                             pattern=r'^del_\d+$'),
+        CallbackQueryHandler(on_confirm_del, pattern=r'^confirm_del$'),
+        CallbackQueryHandler(on_cancel_del, pattern=r'^cancel_del$'),
+        CallbackQueryHandler(on_back_admin, pattern=r'^back_admin$'),
+        CallbackQueryHandler(on_auto_city, pattern=r'^auto_city$'),
+        CallbackQueryHandler(on_manual_city, pattern=r'^manual_city$'),
+        CallbackQueryHandler(on_city_choice,
+                             pattern=r'^(confirm_city|change_city)$'),
+        # Последним — ловушка для кнопок без обработчика, иначе их
+        # нажатия висят с "часиками" до таймаута клиента
+        CallbackQueryHandler(on_unhandled_callback),
+    ]
 
 async def show_account_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -625,15 +1058,43 @@ async def show_account_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔙 Назад", callback_data='back')]
     ]
     
-    await update.callback_query.edit_message_caption(
+    await safe_send(
+        update.callback_query.edit_message_caption,
         caption=f"Ваш баланс: {balance:.2f}₽\nВыберите действие:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     return MAIN_MENU
 
+async def post_init(application: Application):
+    global db
+    db = await Database.connect(DB_NAME)
+    await load_file_ids(application.bot)
+    scheduler.add_job(backup_db_async, 'interval', hours=24)
+    scheduler.start()
+
+async def post_shutdown(application: Application):
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    if db is not None:
+        await db.pool.close()
+
 def main():
     check_geocoders()
-    application = Application.builder().token(TOKEN).build()
+    # 256 соединений хватает на сотни одновременных хендлеров; больше
+    # не помогает — упираемся в лимит Telegram ~30 сообщений/сек на
+    # бота, а сокеты тратятся зря. Для get_updates достаточно одного.
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(256)
+        .pool_timeout(20)
+        .get_updates_connection_pool_size(1)
+        .get_updates_pool_timeout(30)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -646,10 +1107,10 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_city_input)
             ],
             CONFIRM_CITY: [
-                CallbackQueryHandler(handle_callback_queries, pattern='^(confirm_city|change_city)$')
+                CallbackQueryHandler(on_city_choice, pattern='^(confirm_city|change_city)$')
             ],
             MAIN_MENU: [
-                CallbackQueryHandler(handle_callback_queries),
+                *build_callback_handlers(),
                 InlineQueryHandler(handle_inline_query)
             ],
             DEPOSIT_AMOUNT: [
@@ -661,9 +1122,7 @@ def main():
             GET_MODEL_PHOTO: [
                 MessageHandler(filters.PHOTO, save_model_photo)
             ],
-            CONFIRM_DELETE_MODEL: [
-                CallbackQueryHandler(handle_callback_queries)
-            ]
+            CONFIRM_DELETE_MODEL: build_callback_handlers()
         },
         fallbacks=[CommandHandler('admin', admin_panel)],
         allow_reentry=True
@@ -672,13 +1131,19 @@ def main():
     # Регистрация обработчиков
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('admin', admin_panel))
-    application.add_handler(CallbackQueryHandler(handle_callback_queries))
+    application.add_handler(CommandHandler('admin_pool_stats', admin_pool_stats))
+    for handler in build_callback_handlers():
+        application.add_handler(handler)
     
-    try:
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}"
+        )
+    else:
         application.run_polling()
-    finally:
-        db.conn.close()
-        scheduler.shutdown()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file